@@ -1,4 +1,6 @@
+import os
 import socket
+import struct
 from unittest import TestCase
 from unittest.mock import MagicMock
 from operator import attrgetter
@@ -78,3 +80,326 @@ class TestSocket(TestCase):
 
         close_all(pub, sub)
 
+    def test_fragments(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        expected = bytes(range(256)) * 40
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.socket = MagicMock(return_value = mock_socket())
+        tmq_subscribe(sub, pattern, stream=True)
+
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_send(pub, pattern, expected)
+
+        Context.process_tsocket(sub)
+        result = tmq_recv(sub, pattern)
+        self.assertIsInstance(result, bytes)
+        self.assertEqual(result, expected)
+        self.assertEqual(sub.fragments, {})
+        # the streamed fragments still hold the reassembly buffer
+        self.assertEqual(sub.fragments_bytes, len(expected))
+
+        # the same data is available fragment by fragment
+        result = bytearray(len(expected))
+        fragments = list(tmq_recv_stream(sub, pattern))
+        self.assertEqual(len(fragments),
+                         len(td.tmq_pack_fragments(0, pattern, expected, 0)))
+        for msgid, offset, total, data, zipped in fragments:
+            self.assertEqual(total, len(expected))
+            self.assertFalse(zipped)
+            result[offset:offset + len(data)] = data
+        self.assertEqual(result, expected)
+        # released once the context runs
+        self.assertEqual(sub.fragments_bytes, len(expected))
+        Context.process_tsocket(sub)
+        self.assertEqual(sub.fragments_bytes, 0)
+        self.assertEqual(sub.frag_stats['completed'], 1)
+
+        close_all(pub, sub)
+
+    def test_fragments_incomplete(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        data = bytes(range(256)) * 40
+        packets = td.tmq_pack_fragments(td.TMQ_SUB, pattern, data, 7)
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+
+        # only the first fragment arrives
+        s = socket.socket()
+        s.connect(addr)
+        s.sendall(packets[0])
+        s.close()
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+        self.assertEqual(sub.fragments_bytes, len(data))
+
+        # the incomplete message is dropped once it expires
+        sub.fragments[(pattern, 7)].deadline = 0
+        Context.process_tsocket(sub)
+        self.assertEqual(sub.fragments, {})
+        self.assertEqual(sub.fragments_bytes, 0)
+        self.assertEqual(sub.frag_stats['expired'], 1)
+
+        # messages over the memory cap are dropped
+        sub.fragments_bytes = td.TMQ_FRAG_MAX_BYTES
+        s = socket.socket()
+        s.connect(addr)
+        for packed in packets:
+            s.sendall(packed)
+        s.close()
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+        self.assertEqual(sub.fragments, {})
+        self.assertEqual(sub.frag_stats['over_cap'], 1)
+        self.assertEqual(sub.frag_stats['rejected'], 0)
+
+        close_all(sub)
+
+    def test_fragments_duplicate(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        data = bytes(range(256)) * 20
+        packets = td.tmq_pack_fragments(td.TMQ_SUB, pattern, data, 7)
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+
+        # repeated fragments do not complete the message
+        s = socket.socket()
+        s.connect(addr)
+        for _ in packets:
+            s.sendall(packets[0])
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+
+        for packed in packets[1:]:
+            s.sendall(packed)
+        s.close()
+        Context.process_tsocket(sub)
+        self.assertEqual(tmq_recv(sub, pattern), data)
+        self.assertEqual(sub.connections, {})
+        self.assertEqual(sub.frag_stats['rejected'], len(packets) - 1)
+
+        close_all(sub)
+
+    def test_fragments_unsubscribed(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        data = bytes(range(256)) * 20
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+
+        s = socket.socket()
+        s.connect(addr)
+        for packed in td.tmq_pack_fragments(td.TMQ_SUB, pattern, data, 7):
+            s.sendall(packed)
+        s.close()
+        Context.process_tsocket(sub)
+        self.assertEqual(sub.fragments, {})
+        self.assertEqual(sub.fragments_bytes, 0)
+        self.assertEqual(sub.frag_stats['rejected'], 3)
+
+        close_all(sub)
+
+    def test_close_connections(self):
+        '''open connections are closed by the context, not by close()'''
+        addr = ip, ports[0]
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                     struct.pack('ii', 1, 0))  # don't hold addr once closed
+        s.connect(addr)
+        Context.process_tsocket(sub)
+        conn, = sub.connections
+
+        sub.close()
+        self.assertEqual(sub.connections, {conn: sub.connections[conn]})
+        Context._close_connections(sub)
+        self.assertEqual(sub.connections, {})
+        self.assertEqual(conn.fileno(), -1)
+
+        close_all(s)
+
+    def test_fragments_stalled(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        data = bytes(range(256)) * 20
+        packets = td.tmq_pack_fragments(td.TMQ_SUB, pattern, data, 7)
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+        sub.streams[pattern] = deque()
+
+        # the publisher stops in the middle of a fragment. It is reset
+        # when closed so the dropped connection does not hold addr
+        s = socket.socket()
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                     struct.pack('ii', 1, 0))
+        s.connect(addr)
+        s.sendall(packets[0] + packets[1][:100])
+        Context.process_tsocket(sub)
+
+        # the connection and the partial message are dropped
+        self.assertEqual(sub.connections, {})
+        self.assertEqual(sub.fragments, {})
+        fragments = list(tmq_recv_stream(sub, pattern))
+        self.assertEqual(fragments[-1], (7, 0, len(data), None, False))
+        self.assertEqual(sub.frag_stats['expired'], 1)
+        Context.process_tsocket(sub)
+        self.assertEqual(sub.fragments_bytes, 0)
+
+        close_all(s, sub)
+
+    def test_fragments_max_bytes(self):
+        '''a large message is received over several passes'''
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        expected = bytes(range(256)) * 600
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_send(pub, pattern, expected)
+
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+        self.assertEqual(len(sub.connections), 1)
+        Context.process_tsocket(sub)
+        Context.process_tsocket(sub)
+        self.assertEqual(tmq_recv(sub, pattern), expected)
+        self.assertEqual(sub.connections, {})
+
+        close_all(pub, sub)
+
+    def test_compress(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        small = b'houston'
+        expected = b'houston we have lift off ' * 100
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_compress(pub, pattern)
+        tmq_send(pub, pattern, small)
+        tmq_send(pub, pattern, expected)
+        self.assertEqual(pub.zip_stats['compressed'], 1)
+        self.assertGreater(pub.zip_stats['saved_bytes'], 0)
+
+        Context.process_tsocket(sub)
+        self.assertEqual(tmq_recv(sub, pattern), small)
+        self.assertEqual(tmq_recv(sub, pattern), expected)
+        self.assertEqual(sub.zip_stats['decompressed'], 1)
+
+        close_all(pub, sub)
+
+    def test_compress_fragments(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        zdict = bytes(range(256))
+        expected = bytes(range(256)) * 400
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+        tmq_decompress(sub, pattern, zdict)
+
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_compress(pub, pattern, zdict=zdict)
+        tmq_send(pub, pattern, os.urandom(4096) + expected)
+        self.assertEqual(pub.zip_stats['compressed'], 1)
+
+        Context.process_tsocket(sub)
+        result = tmq_recv(sub, pattern)
+        self.assertEqual(result[4096:], expected)
+        self.assertEqual(sub.zip_stats['decompressed'], 1)
+
+        close_all(pub, sub)
+
+    def test_compress_failed(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        expected = b'houston we have lift off ' * 100
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.published[pattern] = deque()
+
+        # the subscriber does not have the publisher's zdict
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_compress(pub, pattern, zdict=b'houston we have')
+        tmq_send(pub, pattern, expected)
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+        self.assertEqual(sub.zip_stats['failed'], 1)
+
+        # corrupt data
+        s = socket.socket()
+        s.connect(addr)
+        s.sendall(td.tmq_pack(td.TMQ_SUB | td.TMQ_ZIP, pattern, b'corrupt'))
+        s.close()
+        Context.process_tsocket(sub)
+        self.assertIsNone(tmq_recv(sub, pattern))
+        self.assertEqual(sub.zip_stats['failed'], 2)
+
+        close_all(pub, sub)
+
+    def test_compress_stream(self):
+        addr = ip, ports[0]
+        pattern = (0, 1)
+        zdict = bytes(range(256))
+        expected = os.urandom(4096) + bytes(range(256)) * 400
+
+        context = mock_context()
+        sub = tmq_socket(context, 0)
+        tmq_bind(sub, addr)
+        sub.socket = MagicMock(return_value = mock_socket())
+        tmq_subscribe(sub, pattern, stream=True)
+        tmq_decompress(sub, pattern, zdict)
+
+        pub = tmq_socket(context, 0)
+        pub.subscribed[pattern] = [addr]
+        tmq_compress(pub, pattern, zdict=zdict)
+        tmq_send(pub, pattern, expected)
+
+        Context.process_tsocket(sub)
+        self.assertEqual(tmq_recv(sub, pattern), expected)
+
+        # the fragments are the zlib stream, in order
+        d = td.zlib.decompressobj(zdict=zdict)
+        result = b''
+        for msgid, offset, total, data, zipped in tmq_recv_stream(sub, pattern):
+            self.assertTrue(zipped)
+            result += d.decompress(data)
+        self.assertEqual(result + d.flush(), expected)
+
+        close_all(pub, sub)
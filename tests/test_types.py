@@ -21,6 +21,45 @@ class TestPacket(TestCase):
         result = td.tmq_unpack(packed)
         self.assertEqual(result, packet)
 
+    def test_pack_fragments(self):
+        tokens = (0x4567, 0xF0F0)
+        data = bytes(range(256)) * 20
+        packets = td.tmq_pack_fragments(td.TMQ_SUB, tokens, data, 42)
+        self.assertGreater(len(packets), 1)
+        result = bytearray(len(data))
+        for packed in packets:
+            self.assertLessEqual(len(packed), td.TMQ_MSG_LEN)
+            type, result_t, frag = td.tmq_unpack(packed)
+            self.assertEqual(type, td.TMQ_SUB | td.TMQ_FRAG)
+            self.assertEqual(result_t, tokens)
+            msgid, offset, total = td.tmq_unpack_frag_t(frag)
+            self.assertEqual((msgid, total), (42, len(data)))
+            chunk = frag[td.FRAG_HEADER_BYTES:]
+            result[offset:offset + len(chunk)] = chunk
+        self.assertEqual(result, data)
+
+
+class TestZip(TestCase):
+    def test_zip_unzip(self):
+        data = b'{"fridge": "temp", "value": 3}' * 20
+        zipped = td.tmq_zip(data)
+        self.assertLess(len(zipped), len(data))
+        self.assertEqual(td.tmq_unzip(zipped), data)
+
+    def test_zip_unzip_zdict(self):
+        zdict = b'{"fridge": "temp", "value": '
+        data = b'{"fridge": "temp", "value": 3}'
+        zipped = td.tmq_zip(data, zdict)
+        self.assertLess(len(zipped), len(td.tmq_zip(data)))
+        self.assertEqual(td.tmq_unzip(zipped, zdict), data)
+        self.assertRaises(td.zlib.error, td.tmq_unzip, zipped)
+
+    def test_unzip_max_length(self):
+        zipped = td.tmq_zip(bytes(1000))
+        self.assertEqual(td.tmq_unzip(zipped, max_length=1000), bytes(1000))
+        self.assertRaises(ValueError, td.tmq_unzip, zipped, max_length=999)
+        self.assertRaises(td.zlib.error, td.tmq_unzip, zipped[:-4])
+
 
 class TestAddresses(TestCase):
     def test_pack_unpack(self):
@@ -1,7 +1,40 @@
+from time import time, sleep, thread_time
+from threading import Thread
 from collections import deque
+import select
+import struct
 
 import tmq.define as td
 
+
+def _recv_exact(conn, view):
+    '''Fill the memoryview from conn.
+    Returns False if the connection closed first'''
+    while len(view):
+        n = conn.recv_into(view)
+        if not n:
+            return False
+        view = view[n:]
+    return True
+
+
+class _reassembly:
+    '''A fragmented message being reassembled into a preallocated buffer'''
+    __slots__ = ('type', 'msgid', 'buffer', 'view', 'offsets', 'received',
+                 'deadline', 'streamed', 'done')
+
+    def __init__(self, type, msgid, total):
+        self.type = type
+        self.msgid = msgid
+        self.buffer = bytearray(total)
+        self.view = memoryview(self.buffer)
+        self.offsets = set()    # offsets of the fragments received
+        self.received = 0
+        self.deadline = time() + td.TMQ_FRAG_TIMEOUT
+        self.streamed = 0       # fragments waiting in a stream queue
+        self.done = False       # no longer being reassembled
+
+
 class Context:
     '''The core handler for tsockets. Does the asyncio loop'''
     def __init__(self, broker):
@@ -16,7 +49,9 @@ class Context:
             start = time()
             # process socket removals during thread execution
             while self._remove:
-                self.tsockets.remove(self._remove.pop())
+                s = self._remove.pop()
+                self.tsockets.remove(s)
+                self._close_connections(s)
 
             for s in self.tsockets:
                 if s.context is None: continue  # socket was closed
@@ -39,28 +74,223 @@ class Context:
         else:
             return Context._process_client(tsocket)
 
+    @staticmethod
+    def _close_connections(tsocket):
+        '''Close the connections of a removed tsocket. Done by the context
+        thread as it is the only one using them'''
+        for conn in tsocket.connections:
+            conn.close()
+        tsocket.connections.clear()
+
     @staticmethod
     def _process_client(tsocket):
+        Context._release_consumed(tsocket)
+        Context._expire_fragments(tsocket)
         while True:
             try:
                 conn, addr = tsocket.listener.accept()
             except BlockingIOError:
-                return
+                break
+            conn.settimeout(td.TMQ_RECV_TIMEOUT)
+            tsocket.connections[conn] = time() + td.TMQ_FRAG_TIMEOUT
 
-            data = conn.recv(td.TMQ_MSG_LEN)
-            data = td.tmq_unpack(data)
-            type, pattern, data = data
-            if type == td.TMQ_SUB:
-                tsocket.published[pattern].appendleft(data)
-            elif type == (td.TMQ_PUB | td.TMQ_CACHE):
-                if pattern not in tsocket.subscribed: raise KeyError
-                tsocket.subscribed[pattern] = tsocket.subscribed[pattern].\
-                    union(td.tmq_unpack_addresses(data))
-            elif type == td.TMQ_PUB | td.TMQ_CACHE | td.TMQ_REMOVE:
-                if pattern not in tsocket.subscribed: raise KeyError
-                tsocket.subscribed[pattern] = tsocket.subscribed[pattern].\
-                    difference(td.tmq_unpack_addresses(data))
-            else: assert(0)
+        # a connection may carry several packets (i.e. fragments) and is
+        # kept open between passes until the peer closes it
+        now = time()
+        for conn, deadline in list(tsocket.connections.items()):
+            try:
+                received = Context._recv_packets(tsocket, conn)
+            except OSError:     # timed out or failed in the middle of a packet
+                received = None
+            if received is None or (not received and deadline < now):
+                del tsocket.connections[conn]
+                conn.close()
+            elif received:
+                tsocket.connections[conn] = now + td.TMQ_FRAG_TIMEOUT
+
+    @staticmethod
+    def _recv_packets(tsocket, conn):
+        '''Receive the packets available on conn, reading at most
+        TMQ_RECV_MAX_BYTES so one connection can not starve the others.
+        Returns the number of bytes received, None if conn was closed'''
+        received = 0
+        while received < td.TMQ_RECV_MAX_BYTES:
+            if not select.select([conn], [], [], 0)[0]:
+                break
+            n = Context._recv_packet(tsocket, conn)
+            if not n:
+                return None
+            received += n
+        return received
+
+    @staticmethod
+    def _recv_packet(tsocket, conn):
+        '''Receive a single packet from conn.
+        Returns the packet length, 0 when the connection has no more packets'''
+        header = bytearray(td.HEADER_BYTES)
+        if not _recv_exact(conn, memoryview(header)):
+            return 0
+        type, tlen, dlen = td.tmq_unpack_header(header)
+        tokens = bytearray(tlen * 4)
+        if not _recv_exact(conn, memoryview(tokens)):
+            return 0
+        pattern = struct.unpack('>{}L'.format(tlen), tokens)
+
+        if type & td.TMQ_FRAG:
+            if not Context._recv_fragment(tsocket, conn, type, pattern, dlen):
+                return 0
+        else:
+            data = bytearray(dlen)
+            if not _recv_exact(conn, memoryview(data)):
+                return 0
+            Context._deliver(tsocket, type, pattern, bytes(data))
+        return td.HEADER_BYTES + len(tokens) + dlen
+
+    @staticmethod
+    def _accepts(tsocket, type, pattern):
+        '''Whether a message of type for pattern would be delivered'''
+        type &= ~(td.TMQ_FRAG | td.TMQ_ZIP)
+        if type == td.TMQ_SUB:
+            return pattern in tsocket.published
+        elif type in (td.TMQ_PUB | td.TMQ_CACHE,
+                      td.TMQ_PUB | td.TMQ_CACHE | td.TMQ_REMOVE):
+            return pattern in tsocket.subscribed
+        return False
+
+    @staticmethod
+    def _deliver(tsocket, type, pattern, data):
+        '''Act on a complete message'''
+        if type & td.TMQ_ZIP:
+            data = Context._unzip(tsocket, pattern, data)
+            if data is None:
+                return  # dropped, see zip_stats['failed']
+            type &= ~td.TMQ_ZIP
+        if type == td.TMQ_SUB:
+            tsocket.published[pattern].appendleft(data)
+        elif type == (td.TMQ_PUB | td.TMQ_CACHE):
+            if pattern not in tsocket.subscribed: raise KeyError
+            tsocket.subscribed[pattern] = tsocket.subscribed[pattern].\
+                union(td.tmq_unpack_addresses(data))
+        elif type == td.TMQ_PUB | td.TMQ_CACHE | td.TMQ_REMOVE:
+            if pattern not in tsocket.subscribed: raise KeyError
+            tsocket.subscribed[pattern] = tsocket.subscribed[pattern].\
+                difference(td.tmq_unpack_addresses(data))
+        else: assert(0)
+
+    @staticmethod
+    def _recv_fragment(tsocket, conn, type, pattern, dlen):
+        '''Receive a fragment directly into its message's reassembly buffer.
+        Fragments that can not be placed (over the memory cap, not wanted,
+        already received or inconsistent with their message) are read and
+        dropped. Returns False if the connection closed first'''
+        frag = bytearray(td.FRAG_HEADER_BYTES)
+        if not _recv_exact(conn, memoryview(frag)):
+            return False
+        msgid, offset, total = td.tmq_unpack_frag_t(frag)
+        length = dlen - td.FRAG_HEADER_BYTES
+        key = pattern, msgid
+
+        # fragments are always cut at multiples of the pattern's fragment
+        # length, so each offset is received at most once
+        step = td.tmq_frag_len(pattern)
+        valid = (offset < total and not offset % step and
+                 length == min(step, total - offset))
+        stats = tsocket.frag_stats
+        over_cap = False
+        r = tsocket.fragments.get(key)
+        if r is None and valid and Context._accepts(tsocket, type, pattern):
+            if tsocket.fragments_bytes + total <= td.TMQ_FRAG_MAX_BYTES:
+                r = tsocket.fragments[key] = _reassembly(type, msgid, total)
+                tsocket.fragments_bytes += total
+            else:
+                over_cap = True
+                if not offset:  # count each message once, at its start
+                    stats['over_cap'] += 1
+                    Context._stream_dropped(tsocket, pattern, msgid, total,
+                                            type)
+        if (r is None or not valid or r.type != type or
+                len(r.buffer) != total or offset in r.offsets):
+            if not over_cap:
+                stats['rejected'] += 1
+            return _recv_exact(conn, memoryview(bytearray(length)))
+
+        try:
+            if not _recv_exact(conn, r.view[offset:offset + length]):
+                Context._finish_fragments(tsocket, key, dropped=True)
+                return False
+        except OSError:
+            Context._finish_fragments(tsocket, key, dropped=True)
+            raise
+        r.offsets.add(offset)
+        r.received += length
+        if pattern in tsocket.streams:
+            r.streamed += 1
+            tsocket.streams[pattern].appendleft((r, offset, length))
+        if r.received == total:
+            stats['completed'] += 1
+            Context._finish_fragments(tsocket, key)
+            Context._deliver(tsocket, type & ~td.TMQ_FRAG, pattern,
+                             bytes(r.buffer))
+        return True
+
+    @staticmethod
+    def _finish_fragments(tsocket, key, dropped=False):
+        '''Stop reassembling a message. Its memory stays counted against
+        TMQ_FRAG_MAX_BYTES until its streamed fragments are consumed.
+        Streams are told about dropped messages'''
+        r = tsocket.fragments.pop(key)
+        r.done = True
+        if not r.streamed:
+            tsocket.fragments_bytes -= len(r.buffer)
+        if not dropped:
+            return
+        tsocket.frag_stats['expired'] += 1
+        pattern, msgid = key
+        Context._stream_dropped(tsocket, pattern, msgid, len(r.buffer), r.type)
+
+    @staticmethod
+    def _stream_dropped(tsocket, pattern, msgid, total, type):
+        '''Tell the pattern's stream (if any) that a message was dropped'''
+        if pattern in tsocket.streams:
+            tsocket.streams[pattern].appendleft(
+                (None, (msgid, 0, total, None, bool(type & td.TMQ_ZIP))))
+
+    @staticmethod
+    def _release_consumed(tsocket):
+        '''Account for the fragments consumed by tmq_recv_stream. Done by
+        the context thread so it alone changes the reassembly memory'''
+        while tsocket.consumed:
+            r = tsocket.consumed.pop()
+            r.streamed -= 1
+            if r.done and not r.streamed:
+                tsocket.fragments_bytes -= len(r.buffer)
+
+    @staticmethod
+    def _unzip(tsocket, pattern, data):
+        '''Decompress data. Returns None if it could not be decompressed'''
+        stats = tsocket.zip_stats
+        if td.zlib is None:
+            stats['failed'] += 1
+            return None
+        start = thread_time()
+        try:
+            data = td.tmq_unzip(data, tsocket.zdicts.get(pattern))
+        except (td.zlib.error, ValueError):
+            data = None
+        stats['decompress_time'] += thread_time() - start
+        if data is None:
+            stats['failed'] += 1
+        else:
+            stats['decompressed'] += 1
+        return data
+
+    @staticmethod
+    def _expire_fragments(tsocket):
+        '''Drop messages that have not been fully received in time'''
+        now = time()
+        for key, r in list(tsocket.fragments.items()):
+            if r.deadline < now:
+                Context._finish_fragments(tsocket, key, dropped=True)
 
     @staticmethod
     def _process_broker(tsocket):
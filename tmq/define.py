@@ -3,9 +3,21 @@ from enum import Enum
 from operator import xor
 import struct
 
+try:
+    import zlib
+except ImportError:     # not every embedded python ships zlib
+    zlib = None
+
 HEADER_BYTES = 4
+FRAG_HEADER_BYTES = 12
 TMQ_MSG_LEN = 2056
 TMQ_LOOP_TIME = 5e-3
+TMQ_FRAG_TIMEOUT = 5.0          # seconds before an incomplete message is dropped
+TMQ_FRAG_MAX_BYTES = 0x1000000  # max bytes of in-flight reassembly per tsocket
+TMQ_RECV_TIMEOUT = 0.1          # seconds a stalled peer can block a recv
+TMQ_RECV_MAX_BYTES = 0x10000    # max bytes read per connection per loop pass
+TMQ_ZIP_THRESHOLD = 256         # default min data length to compress
+TMQ_ZIP_LEVEL = 1               # zlib level, favor speed over ratio
 
 # Flags
 TMQ_DONTWAIT        = 0x01
@@ -24,6 +36,8 @@ So for instance:
 type                                | Result
 ------------------------------------|------------------------------------------
 (TMQ_SUB)                           | message from a pub client->sub client
+(TMQ_SUB|TMQ_FRAG)                  | fragment of a message pub client->sub client
+(TMQ_SUB|TMQ_ZIP)                   | compressed message pub client->sub client
 (TMQ_SUB|TMQ_CACHE|TMQ_BROKER)      | Add self as subscriber of tokens
 (TMQ_PUB|TMQ_CACHE|TMQ_BROKER)      | Add self as publisher of tokens
 (TMQ_SUB|TMQ_CACHE)                 | Add token:end to client cache of subs
@@ -35,8 +49,8 @@ TMQ_PUB             = 0x01      # Publisher type
 TMQ_SUB             = 0x02      # Subscriber type
 TMQ_CACHE           = 0x04      # call to update jkjthe cache
 TMQ_REMOVE          = 0x08      # remove command
-TMQ_                = 0x10
-TMQ_                = 0x20
+TMQ_FRAG            = 0x10      # data is a fragment of a larger message
+TMQ_ZIP             = 0x20      # data is zlib compressed
 
 # Role Types
 TMQ_CLIENT          = 0x00      # Client role
@@ -87,14 +101,91 @@ def tmq_pack(type, tokens, data=b''):
              + data)
 
 
+def tmq_unpack_header(data):
+    '''Unpack the fixed size header of a packet into (type, tlen, dlen)'''
+    return struct.unpack('>bbH', data[:HEADER_BYTES])
+
+
 def tmq_unpack(data):
-    type, tlen, dlen = struct.unpack('>bbH', data[:HEADER_BYTES])
+    type, tlen, dlen = tmq_unpack_header(data)
     tokens = struct.unpack('>{}L'.format(tlen),
                            data[HEADER_BYTES:HEADER_BYTES + tlen * 4])
     data = data[HEADER_BYTES + tlen * 4:]
     return type, tokens, data
 
 
+def tmq_zip(data, zdict=None, level=TMQ_ZIP_LEVEL):
+    '''Compress data with zlib, optionally using a preset dictionary'''
+    if zdict is None:
+        return zlib.compress(data, level)
+    c = zlib.compressobj(level, zdict=zdict)
+    return c.compress(data) + c.flush()
+
+
+def tmq_unzip(data, zdict=None, max_length=TMQ_FRAG_MAX_BYTES):
+    '''Decompress data made by tmq_zip with the same preset dictionary.
+
+    Raises:
+        zlib.error: if data is corrupt or the wrong zdict is used
+        ValueError: if data decompresses to more than max_length bytes
+    '''
+    if zdict is None:
+        d = zlib.decompressobj()
+    else:
+        d = zlib.decompressobj(zdict=zdict)
+    out = d.decompress(data, max_length)
+    if d.unconsumed_tail:
+        raise ValueError("decompressed data is over {} bytes".format(
+            max_length))
+    if not d.eof:
+        raise zlib.error("incomplete compressed data")
+    return out
+
+
+def tmq_pack_frag_t(msgid, offset, total):
+    '''The fragment header is packed at the start of the data as follows:
+
+    bytes: 4        | 4       | 4
+    name : msgid    | offset  | total
+
+    msgid identifies the message the fragment belongs to, offset is where
+    the fragment's data starts in the message and total is the length
+    of the whole message (so the receiver can preallocate it)
+    '''
+    return struct.pack('>LLL', msgid, offset, total)
+
+
+def tmq_unpack_frag_t(packed_frag):
+    return struct.unpack('>LLL', packed_frag[:FRAG_HEADER_BYTES])
+
+
+def tmq_frag_len(tokens):
+    '''Maximum fragment data length so a packet fits in TMQ_MSG_LEN'''
+    return TMQ_MSG_LEN - HEADER_BYTES - 4 * len(tokens) - FRAG_HEADER_BYTES
+
+
+def tmq_pack_fragments(type, tokens, data, msgid):
+    '''Split data into (type | TMQ_FRAG) packets that each fit in
+    TMQ_MSG_LEN. Slices data with a memoryview so each fragment is only
+    copied once, into its packet.
+
+    Returns:
+        list of bytes: the packets, in order
+    '''
+    type |= TMQ_FRAG
+    view = memoryview(data)
+    total = len(view)
+    step = tmq_frag_len(tokens)
+    packets = []
+    for offset in range(0, total, step):
+        chunk = view[offset:offset + step]
+        header = struct.pack(">bbH{}L".format(len(tokens)), type, len(tokens),
+                             FRAG_HEADER_BYTES + len(chunk), *tokens)
+        packets.append(b''.join((header, tmq_pack_frag_t(msgid, offset, total),
+                                 chunk)))
+    return packets
+
+
 def tmq_pack_address_t(address, port):
     '''The socket data type is packed as follows:
 
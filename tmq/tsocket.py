@@ -1,7 +1,8 @@
-from time import time, sleep
+from time import time, sleep, thread_time
 from threading import Thread
 import socket
 from collections import deque
+from random import getrandbits
 
 from tmq import define as td
 
@@ -41,6 +42,30 @@ class tsocket:
         self._broker = None
         self.published = {}  # client=published data. broker=publishers
         self.subscribed = {}  # subscribers
+        self.streams = {}  # patterns streaming fragments as they arrive
+        self.fragments = {}  # (pattern, msgid): in-flight reassembly
+        self.fragments_bytes = 0  # memory used by reassembly and streams
+        self.consumed = deque()  # streamed fragments consumed by the user
+        self.connections = {}  # open connection: idle deadline
+        self.frag_stats = {
+            'completed': 0,         # fragmented messages received
+            'over_cap': 0,          # messages dropped for TMQ_FRAG_MAX_BYTES
+            'expired': 0,           # incomplete messages dropped
+            'rejected': 0,          # fragments dropped: repeated,
+                                    # inconsistent or not subscribed
+        }
+        self._msgid = getrandbits(32)  # id of the next fragmented message
+        self.compression = {}  # pattern: (threshold, zdict) for sending
+        self.zdicts = {}  # pattern: zdict for receiving
+        self.zip_stats = {
+            'compressed': 0,        # messages sent compressed
+            'saved_bytes': 0,       # bytes not sent thanks to compression
+            'compress_time': 0.0,   # CPU seconds spent compressing
+            'decompressed': 0,      # messages received compressed
+            'decompress_time': 0.0, # CPU seconds spent decompressing
+            'failed': 0,            # received messages that failed to
+                                    # decompress (dropped)
+        }
         self.context.tsockets.append(self)
         self.queue = deque  # queue of things to do
 
@@ -71,7 +96,11 @@ def tmq_socket(context, role=td.TMQ_CLIENT, socket_constructor=socket.socket):
     return tsocket(context, role, socket_constructor)
 
 
-def tmq_subscribe(tsocket, pattern):
+def tmq_subscribe(tsocket, pattern, stream=False):
+    '''Inform the broker we are a subscriber of pattern.
+
+    If stream is True, fragments of large messages can also be consumed
+    as they arrive with tmq_recv_stream'''
     if pattern in tsocket.published:
         raise ValueError("Subscribing to {} twice".format(pattern))
     s = tsocket.socket()
@@ -82,6 +111,8 @@ def tmq_subscribe(tsocket, pattern):
             td.tmq_pack_address_t(*tsocket.listener.getsockname())))
     finally: s.close()
     tsocket.published[pattern] = deque()
+    if stream:
+        tsocket.streams[pattern] = deque()
 
 
 def tmq_publish(tsocket, pattern):
@@ -102,7 +133,13 @@ def tmq_publish(tsocket, pattern):
 
 def tmq_send(tsocket, pattern, data, flags=0):
     '''Publish data to subscribers of pattern.
-    Block until there are endpoints available from the server'''
+    Block until there are endpoints available from the server
+
+    Data is compressed once (not per subscriber) if compression is enabled
+    for pattern with tmq_compress and it is larger than the threshold.
+
+    Data too large for a single packet is split into TMQ_FRAG packets
+    which are all sent over the same connection'''
     if not isinstance(pattern, td.pattern):
         pattern = td.pattern(*pattern)
     if pattern not in tsocket.subscribed:
@@ -111,12 +148,32 @@ def tmq_send(tsocket, pattern, data, flags=0):
     endpoints = tsocket.subscribed[pattern]
     if not endpoints:
         return 1
-    packet = td.tmq_pack(td.TMQ_SUB, pattern, data)
+    type = td.TMQ_SUB
+    if pattern in tsocket.compression:
+        threshold, zdict = tsocket.compression[pattern]
+        if len(data) >= threshold:
+            start = thread_time()
+            zipped = td.tmq_zip(data, zdict)
+            stats = tsocket.zip_stats
+            stats['compress_time'] += thread_time() - start
+            if len(zipped) < len(data):
+                stats['compressed'] += 1
+                stats['saved_bytes'] += ((len(data) - len(zipped))
+                                         * len(endpoints))
+                type |= td.TMQ_ZIP
+                data = zipped
+    if len(data) > td.tmq_frag_len(pattern) + td.FRAG_HEADER_BYTES:
+        packets = td.tmq_pack_fragments(type, pattern, data,
+                                        tsocket._msgid)
+        tsocket._msgid = (tsocket._msgid + 1) & 0xFFFFFFFF
+    else:
+        packets = (td.tmq_pack(type, pattern, data),)
     for addr in endpoints:
         s = tsocket.socket()
         try:
             s.connect(addr)
-            s.send(packet)
+            for packet in packets:
+                s.sendall(packet)
         finally: s.close()
     return 1
 
@@ -136,6 +193,61 @@ def tmq_recv(tsocket, pattern):
         return None
 
 
+def tmq_recv_stream(tsocket, pattern):
+    '''Non blocking iterator over the fragments received so far for a
+    pattern subscribed with stream=True. Complete messages are still
+    returned by tmq_recv.
+
+    Streamed fragments count against TMQ_FRAG_MAX_BYTES until they are
+    consumed (and the context has run), so a stream that is not read will
+    eventually make large messages be dropped.
+
+    Yields:
+        tuple: (msgid, offset, total, data, zipped) where data is a
+            memoryview into the message's reassembly buffer. If zipped is
+            True the message was compressed by tmq_compress and data is the
+            zlib stream: feed it in order to a zlib.decompressobj using
+            the pattern's zdict. If the message was dropped before it was
+            complete, data is None.
+    '''
+    queue = tsocket.streams[pattern]
+    while queue:
+        entry = queue.pop()
+        if entry[0] is None:    # dropped message
+            yield entry[1]
+            continue
+        r, offset, length = entry
+        tsocket.consumed.appendleft(r)  # released by the context thread
+        yield (r.msgid, offset, len(r.buffer), r.view[offset:offset + length],
+               bool(r.type & td.TMQ_ZIP))
+
+
+def tmq_compress(tsocket, pattern, threshold=td.TMQ_ZIP_THRESHOLD,
+                 zdict=None):
+    '''Compress data sent to pattern that is at least threshold bytes long.
+
+    zdict is an optional preset dictionary (bytes) of content common to
+    the pattern's messages. Subscribers must register the same zdict with
+    tmq_decompress, without a zdict decompression is automatic.
+    '''
+    if td.zlib is None:
+        raise ImportError("zlib is required for compression")
+    if not isinstance(pattern, td.pattern):
+        pattern = td.pattern(*pattern)
+    tsocket.compression[pattern] = threshold, zdict
+
+
+def tmq_decompress(tsocket, pattern, zdict):
+    '''Decompress data received for pattern with the preset dictionary
+    given to tmq_compress by its publishers. Messages that fail to
+    decompress are dropped and counted in zip_stats['failed'].'''
+    if td.zlib is None:
+        raise ImportError("zlib is required for compression")
+    if not isinstance(pattern, td.pattern):
+        pattern = td.pattern(*pattern)
+    tsocket.zdicts[pattern] = zdict
+
+
 def tmq_bind(tsocket, endpoint, backlog=5):
     '''Bind the tsocket to listen/subscribe on a specific endpoint'''
     if tsocket.listener: